@@ -1,26 +1,88 @@
+import hashlib
+import io
 import os
-import re
+import sqlite3
 import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
 
+import numpy as np
 import streamlit as st
-from openai import OpenAI
+import tiktoken
+from openai import NOT_GIVEN, OpenAI
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+T = TypeVar("T")
+R = TypeVar("R")
+ByteBuffer = Union[bytes, bytearray, memoryview]
 
 
 # ----------------------------
 # Prompt templates
 # ----------------------------
 
-DEFAULT_PROMPT_TEMPLATE = """\
+# The Pass 1 prompt is laid out as a fixed instruction block followed by the
+# per-request inputs, so every chunk (and every run, whatever the selected
+# services) shares the same leading tokens and benefits from OpenAI prompt caching.
+# Caching only applies to prefixes of at least 1024 tokens; the static block is
+# kept above that (~1.3k tokens), so trim it with care.
+PROMPT_STATIC_PREFIX = """\
 You are a senior software engineer and incident analyst with strong expertise in
 telecom systems, VoIP, FreeSWITCH, SIP signaling, and distributed service orchestration.
 
 I will provide you with runtime traces and logs.
 
-Your task is to analyze the traces **only with respect to the following target services**:
-
-TARGET_SERVICES = {target_services}
+Your task is to analyze the traces **only with respect to the target services**
+given in TARGET_SERVICES at the end of this message, right before the log chunk.
+
+About the input:
+- The log chunk is an excerpt of a journalctl export, pre-filtered to the lines
+  that mention a target service plus a window of surrounding context lines.
+- Lines typically follow the journalctl short format:
+  `<timestamp> <host> <unit or process>[<pid>]: <message>`.
+- Gaps between kept regions are not marked; do not assume consecutive lines are
+  adjacent in time unless their timestamps show it.
+- The chunk may start or end in the middle of a sequence of related events; note
+  such truncation instead of guessing the missing part.
+- A change of PID for the same unit indicates a process restart.
+
+Reading the log (reference):
+- systemd lifecycle lines come from the `systemd[1]` unit, e.g. "Starting X...",
+  "Started X.", "Stopping X...", "X: Main process exited, code=exited,
+  status=1/FAILURE", "X: Failed with result 'exit-code'", "X: Scheduled restart
+  job, restart counter is at N", "Reloading." and "Reloaded X.". Treat a rising
+  restart counter as a crash loop, not as independent incidents.
+- FreeSWITCH console lines usually carry a level tag such as [DEBUG], [INFO],
+  [NOTICE], [WARNING], [ERR], [CRIT] or [ALERT], often followed by the source
+  file and line (e.g. `sofia.c:1234`, `mod_sofia.c`, `switch_core_state_machine.c`)
+  and sometimes a channel UUID. Use the UUID to follow one call across lines.
+- Sofia/SIP profile and gateway states include REGED, UNREGED, TRYING,
+  REGISTER, FAILED, FAIL_WAIT, EXPIRED and NOREG; "Invalid Gateway" means a
+  gateway was referenced before it was (re)loaded or after it was removed.
+  Profile "rescan", "restart" and "killgw" commands change gateway state and
+  should appear in the timeline.
+- SIP response codes: 100/180/183 are provisional; 200 is success; 401/407 are
+  normal authentication challenges unless they repeat without a following 200;
+  403 is a rejected credential or policy; 404 an unknown user or route; 408 and
+  503 indicate the remote side was unreachable or overloaded; 480/486/487 are
+  call-level outcomes (unavailable, busy, cancelled), not infrastructure faults.
+- Network-side signals worth correlating with SIP failures: interface up/down,
+  DHCP lease renewals or address changes, DNS resolution failures, NTP or clock
+  jumps, and firewall or NAT messages. A SIP failure shortly after an address
+  change usually points to stale bindings rather than a remote outage.
+- Repeated identical lines are evidence of a loop or retry storm; report the
+  count and the first/last timestamps instead of restating each occurrence.
+
+Evidence rules:
+- Quote the exact log text (or a distinctive fragment of it) with its timestamp
+  for every event you rely on, so findings can be traced back to the source.
+- Distinguish clearly between what the log shows, what it implies, and what is
+  hypothesis; never present a hypothesis as an observed fact.
+- If a target service does not appear in the chunk at all, say so in one line
+  and do not invent activity for it.
+- Keep timestamps in the form they appear in the log; do not convert time zones.
 
 For each service listed in TARGET_SERVICES, perform the following steps:
 
@@ -70,6 +132,11 @@ Formatting requirements:
 - Be precise and technical.
 - Do not speculate beyond trace evidence.
 - Prefer deterministic language over generic explanations.
+"""
+
+PROMPT_DYNAMIC_SUFFIX = """\
+
+TARGET_SERVICES = {target_services}
 
 LOG CHUNK:
 ```text
@@ -77,6 +144,8 @@ LOG CHUNK:
 ```\
 """
 
+DEFAULT_PROMPT_TEMPLATE = PROMPT_STATIC_PREFIX + PROMPT_DYNAMIC_SUFFIX
+
 SYNTHESIS_PROMPT = """\
 You are consolidating multiple chunk-level analyses of the same incident.
 Combine them into ONE coherent incident report.
@@ -94,81 +163,517 @@ CHUNK ANALYSES:
 {chunk_analyses}
 """
 
+COMPRESS_PROMPT = """\
+Reduce the incident analysis below to the evidence it contains, as terse bullet points:
+timestamps, events, errors, state changes and recovery actions for the target services.
+Keep hypotheses only if they are explicitly labeled as such. No headers, no prose.
+
+TARGET_SERVICES = {target_services}
+
+ANALYSIS:
+{analysis}
+"""
+
+MERGE_PROMPT = """\
+You are merging two partial analyses of the same incident into one.
+Each one covers the log chunks listed in its label; lower chunk numbers are
+earlier in the log. The chunk sets may be interleaved or have gaps.
+
+Requirements:
+- Merge duplicated information.
+- Keep a single chronological timeline per service.
+- Keep evidence-based statements.
+- Clearly label hypotheses.
+- Do not write a final summary; the result will be merged again.
+
+TARGET_SERVICES = {target_services}
+
+{first_label} ANALYSIS:
+{first}
+
+{second_label} ANALYSIS:
+{second}
+"""
+
 
 # ----------------------------
 # Utilities
 # ----------------------------
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Embeddings API limits are 2048 inputs, ~8k tokens per input and ~300k tokens per
+# request; budgets are in characters at a conservative ~2 chars per token.
+EMBEDDING_MAX_BATCH_INPUTS = 2048
+EMBEDDING_MAX_INPUT_CHARS = 16_000
+EMBEDDING_MAX_BATCH_CHARS = 400_000
+# Output budget for the evidence-bullet digest of each chunk analysis fed to Pass 2.
+COMPRESS_MAX_OUTPUT_TOKENS = 400
+# Chunk analyses at least this similar (cosine) are treated as repeats of each other.
+DUPLICATE_SIMILARITY = 0.92
+
+
 def parse_target_services(raw: str) -> List[str]:
     parts = [p.strip() for p in raw.split(",")]
     return [p for p in parts if p]
 
 
-def filter_lines_with_context(
-    lines: List[str],
-    target_services: List[str],
-    context: int,
-    max_lines: int,
-) -> Tuple[List[str], int]:
+def index_line_ends(buf: ByteBuffer) -> np.ndarray:
     """
-    Returns filtered lines plus the number of 'hits' (lines that matched directly).
-    Strategy: keep any line matching any target service token (case-insensitive),
-    plus +/- context lines around each hit. Deduplicate via index set.
+    Returns the byte offset where each line ends (its '\n', or EOF for an
+    unterminated last line). One entry per line, so len() is the line count.
     """
-    if not target_services:
-        return [], 0
+    ends = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord("\n"))
+    if len(buf) and buf[-1] != ord("\n"):
+        ends = np.append(ends, len(buf))
+    return ends
 
-    patterns = [re.compile(re.escape(svc), re.IGNORECASE) for svc in target_services]
 
-    hit_idxs = []
-    for i, line in enumerate(lines):
-        if any(p.search(line) for p in patterns):
-            hit_idxs.append(i)
-
-    keep = set()
+def iter_hit_lines(
+    buf: ByteBuffer,
+    line_ends: np.ndarray,
+    target_services: List[str],
+    block_lines: int = 1 << 16,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Yields the sorted indices of lines containing any target service token (ASCII
+    case-insensitive), one array per block of `block_lines` lines, in file order,
+    each paired with the index of the block's last line. Only the current block is
+    lowercased, and the caller can stop early.
+
+    Within a block each token is located with bytes.find; after a hit the scan
+    jumps past the end of that line, so the Python-level loop runs once per
+    matching line rather than once per occurrence.
+    """
+    needles = {svc.encode("utf-8").lower() for svc in target_services}
+    for first in range(0, len(line_ends), block_lines):
+        last = min(first + block_lines, len(line_ends)) - 1
+        start = int(line_ends[first - 1]) + 1 if first else 0
+        block = bytes(buf[start : int(line_ends[last])]).lower()
+
+        hit_ends = []
+        for needle in needles:
+            pos = block.find(needle)
+            while pos != -1:
+                eol = block.find(b"\n", pos)
+                if eol == -1:
+                    hit_ends.append(len(block))
+                    break
+                hit_ends.append(eol)
+                pos = block.find(needle, eol + 1)
+
+        yield last, np.unique(np.searchsorted(line_ends, np.asarray(hit_ends, dtype=np.int64) + start))
+
+
+def merge_context_windows(
+    hit_idxs: Sequence[int],
+    context: int,
+    n_lines: int,
+    merged: Optional[List[Tuple[int, int]]] = None,
+) -> List[Tuple[int, int]]:
+    """
+    Coalesces the +/- context window around each (sorted) hit into disjoint,
+    inclusive (start, end) line ranges in a single linear sweep. Passing the
+    result of a previous call as `merged` continues it with later hits.
+    """
+    if merged is None:
+        merged = []
     for i in hit_idxs:
-        start = max(0, i - context)
-        end = min(len(lines) - 1, i + context)
-        for j in range(start, end + 1):
-            keep.add(j)
+        lo, hi = max(0, i - context), min(n_lines - 1, i + context)
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
 
-    kept_sorted = sorted(keep)
-    filtered = [lines[i].rstrip("\n") for i in kept_sorted]
 
-    # Safety cap (prevents enormous prompt payloads if tokens match too broadly)
-    if max_lines and len(filtered) > max_lines:
-        filtered = filtered[:max_lines]
+@st.cache_data(show_spinner=False)
+def filter_lines_with_context(
+    _buf: ByteBuffer,
+    _line_ends: np.ndarray,
+    buf_digest: str,
+    target_services: List[str],
+    context: int,
+    max_lines: int,
+) -> Tuple[str, int, int, bool, bool]:
+    """
+    Returns (text, kept, hits, truncated, scan_stopped_early):
+    - text / kept: the filtered text and its line count
+    - hits: the number of lines that matched directly
+    - truncated: kept lines were dropped to respect max_lines
+    - scan_stopped_early: part of the file was never scanned (see below)
 
-    return filtered, len(hit_idxs)
+    Strategy: keep any line matching any target service token (case-insensitive),
+    plus +/- context lines around each hit. Each merged run of kept lines is
+    decoded from the raw buffer as one block and written straight into the output,
+    so no per-line list is ever built.
 
+    The file is scanned in line order and the scan stops as soon as max_lines kept
+    lines are guaranteed, so an over-broad token costs a bounded amount of work;
+    'hits' then counts only the scanned part.
 
-def chunk_text_by_chars(text: str, chunk_size: int) -> List[str]:
+    Cached across reruns; the buffer is identified by `buf_digest` (its SHA-256)
+    rather than being re-hashed by Streamlit on every widget change.
+    """
+    if not target_services or not len(_line_ends):
+        return "", 0, 0, False, False
+
+    windows: List[Tuple[int, int]] = []
+    hits = 0
+    covered = 0
+    scan_stopped_early = False
+    for last, block_hits in iter_hit_lines(_buf, _line_ends, target_services):
+        hits += len(block_hits)
+        windows = merge_context_windows(block_hits.tolist(), context, len(_line_ends), windows)
+        covered = sum(hi - lo + 1 for lo, hi in windows)
+        # Later hits only add lines after the current ones, so once the cap is
+        # covered the kept prefix is final.
+        if max_lines and covered >= max_lines:
+            scan_stopped_early = last + 1 < len(_line_ends)
+            break
+
+    sink = io.StringIO()
+    kept = 0
+    for lo, hi in windows:
+        # Safety cap (prevents enormous prompt payloads if tokens match too broadly)
+        if max_lines:
+            if kept >= max_lines:
+                break
+            hi = min(hi, lo + max_lines - kept - 1)
+
+        start = int(_line_ends[lo - 1]) + 1 if lo else 0
+        stop = int(_line_ends[hi])
+        if stop > start and _buf[stop - 1] == ord("\r"):
+            stop -= 1
+        if kept:
+            sink.write("\n")
+        # CRLF exports: the block's inner line endings are normalized in one pass.
+        sink.write(str(_buf[start:stop], "utf-8", "replace").replace("\r\n", "\n"))
+        kept += hi - lo + 1
+
+    return sink.getvalue(), kept, hits, covered > kept, scan_stopped_early
+
+
+@st.cache_resource
+def get_token_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Models unknown to this tiktoken release use the current-generation encoding.
+        return tiktoken.get_encoding("o200k_base")
+
+
+@st.cache_data(show_spinner=False)
+def chunk_lines_by_tokens(text: str, max_tokens: int, model: str) -> List[str]:
+    """
+    Splits text into chunks of whole lines, each holding at most max_tokens tokens
+    as counted by the model's tokenizer. A single line over the budget becomes a
+    chunk of its own rather than being cut. If the tokenizer can't be loaded
+    (tiktoken downloads its BPE files on first use, which fails offline), token
+    counts are estimated as characters / 4.
+    """
     text = text.strip()
     if not text:
         return []
-    if chunk_size <= 0:
+    lines = text.split("\n")
+    if max_tokens <= 0:
         return [text]
-    return [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    try:
+        encoding = get_token_encoding(model)
+    except Exception:
+        encoding = None
+    if encoding is not None:
+        counts = [len(toks) + 1 for toks in encoding.encode_ordinary_batch(lines)]  # +1 for "\n"
+    else:
+        counts = [len(line) // 4 + 1 for line in lines]
+
+    chunks: List[str] = []
+    start, budget = 0, 0
+    for i, n in enumerate(counts):
+        if budget + n > max_tokens and i > start:
+            chunks.append("\n".join(lines[start:i]))
+            start, budget = i, 0
+        budget += n
+    chunks.append("\n".join(lines[start:]))
+    return chunks
 
 
 @dataclass
 class OpenAIConfig:
     api_key: str
-    model: str
+    pass1_model: str
+    pass2_model: str
     temperature: float
 
 
-def call_openai_responses(client: OpenAI, model: str, temperature: float, prompt: str) -> str:
+class ResponseCache:
+    """
+    Persistent SQLite store of model outputs keyed by a SHA-256 of the request, so
+    identical analyses survive app restarts and browser sessions.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, output TEXT NOT NULL)")
+
+    @staticmethod
+    def make_key(model: str, temperature: float, prompt: str, max_output_tokens: Optional[int] = None) -> str:
+        parts = (model, repr(temperature), prompt)
+        if max_output_tokens is not None:
+            parts += (str(max_output_tokens),)
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT output FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, output: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, output) VALUES (?, ?)", (key, output))
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite3"))
+
+
+def fetch_with_response_cache(
+    model: str,
+    temperature: float,
+    prompt: str,
+    max_output_tokens: Optional[int],
+    fetch: Callable[[], Any],
+) -> Tuple[str, bool]:
+    """
+    Shared ResponseCache policy for every Responses API call. Deterministic
+    (temperature 0) requests are served from disk when possible; otherwise fetch()
+    is called and must return the final Response, whose text is persisted only if
+    it is complete and non-empty. Returns (output, complete).
+    """
+    cache = get_response_cache() if temperature == 0 else None
+    key = ResponseCache.make_key(model, temperature, prompt, max_output_tokens)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached, True
+
+    resp = fetch()
+    output = resp.output_text or ""
+    complete = resp.status == "completed" and bool(output)
+
+    # Only complete, non-empty answers are pinned; truncated or filtered ones are retried next time.
+    if cache is not None and complete:
+        cache.set(key, output)
+    return output, complete
+
+
+class _IncompleteResponse(Exception):
+    """Carries an incomplete or empty output past st.cache_data, which doesn't memoize exceptions."""
+
+    def __init__(self, output: str):
+        super().__init__("incomplete response")
+        self.output = output
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _call_openai_responses_memo(
+    _client: OpenAI,
+    model: str,
+    temperature: float,
+    prompt: str,
+    max_output_tokens: Optional[int],
+) -> str:
+    output, complete = fetch_with_response_cache(
+        model,
+        temperature,
+        prompt,
+        max_output_tokens,
+        lambda: _client.responses.create(
+            model=model,
+            input=prompt,
+            temperature=temperature,
+            max_output_tokens=NOT_GIVEN if max_output_tokens is None else max_output_tokens,
+        ),
+    )
+    if not complete:
+        raise _IncompleteResponse(output)
+    return output
+
+
+def call_openai_responses(
+    client: OpenAI,
+    model: str,
+    temperature: float,
+    prompt: str,
+    max_output_tokens: Optional[int] = None,
+) -> str:
     """
     Uses the Responses API. The SDK supports constructing the client with env var
     or explicit api_key; we use an explicit key here (already resolved).
+    Complete results are cached per (model, temperature, prompt) so reruns and
+    repeated Analyze clicks don't re-issue identical requests, and deterministic
+    calls (temperature 0) are additionally persisted to disk via ResponseCache.
+    Truncated, filtered or empty output is returned as-is but never cached, so it
+    is requested again next time.
     """
-    resp = client.responses.create(
-        model=model,
-        input=prompt,
-        temperature=temperature,
-    )
-    return resp.output_text or ""
+    try:
+        return _call_openai_responses_memo(client, model, temperature, prompt, max_output_tokens)
+    except _IncompleteResponse as e:
+        return e.output
+
+
+def stream_openai_responses(
+    client: OpenAI,
+    model: str,
+    temperature: float,
+    prompt: str,
+    on_text: Callable[[str], None],
+    deltas_per_update: int = 32,
+) -> str:
+    """
+    Streaming variant of call_openai_responses: on_text receives the accumulated
+    output as it is generated, so the caller can render it incrementally. Updates
+    are throttled to completed lines (or every `deltas_per_update` deltas) so a
+    long report isn't re-sent in full on every token.
+    Not wrapped in st.cache_data (it drives UI elements created by the caller);
+    deterministic results still go through ResponseCache.
+    """
+
+    def fetch() -> Any:
+        parts: List[str] = []
+        pending = 0
+        with client.responses.stream(model=model, input=prompt, temperature=temperature) as stream:
+            for event in stream:
+                if event.type != "response.output_text.delta":
+                    continue
+                parts.append(event.delta)
+                pending += 1
+                if "\n" in event.delta or pending >= deltas_per_update:
+                    on_text("".join(parts))
+                    pending = 0
+            return stream.get_final_response()
+
+    output, _ = fetch_with_response_cache(model, temperature, prompt, None, fetch)
+    on_text(output)
+    return output
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def embed_texts(_client: OpenAI, model: str, texts: List[str]) -> np.ndarray:
+    """
+    Embeds texts in as many requests as the per-request limits require. Each text
+    is cut to its leading EMBEDDING_MAX_INPUT_CHARS, which is plenty to tell
+    near-duplicates apart.
+    """
+    inputs = [text[:EMBEDDING_MAX_INPUT_CHARS] for text in texts]
+    vectors: List[List[float]] = []
+    start = 0
+    while start < len(inputs):
+        stop, chars = start, 0
+        while (
+            stop < len(inputs)
+            and stop - start < EMBEDDING_MAX_BATCH_INPUTS
+            and (stop == start or chars + len(inputs[stop]) <= EMBEDDING_MAX_BATCH_CHARS)
+        ):
+            chars += len(inputs[stop])
+            stop += 1
+        resp = _client.embeddings.create(model=model, input=inputs[start:stop])
+        vectors.extend(d.embedding for d in resp.data)
+        start = stop
+    return np.array(vectors, dtype=np.float32)
+
+
+def group_near_duplicates(embeddings: np.ndarray, threshold: float) -> List[List[int]]:
+    """
+    Greedy clustering by cosine similarity: each item joins the first group whose
+    representative (its first member) is at least `threshold` similar, otherwise
+    it starts a new group. Groups come back in order of first appearance.
+    """
+    unit = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    sims = unit @ unit.T
+
+    groups: List[List[int]] = []
+    for i in range(len(unit)):
+        for group in groups:
+            if sims[i, group[0]] >= threshold:
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+    return groups
+
+
+def compile_prompt_template(template: str, target_services: List[str]) -> Callable[[str], str]:
+    """
+    Formats the Pass 1 template once, leaving a marker where {log_text} goes, and
+    returns a function that splices a chunk into the pre-rendered pieces. Building
+    each chunk's prompt is then a plain join, with no template parsing per chunk.
+    """
+    marker = "\x00LOG_TEXT\x00"
+    parts = template.format(target_services=target_services, log_text=marker).split(marker)
+    return lambda log_text: log_text.join(parts)
+
+
+def label_chunks(numbers: Sequence[int]) -> str:
+    """Labels a sorted set of chunk numbers, collapsing runs: "Chunks 1-3, 7, 9"."""
+    runs: List[str] = []
+    start = prev = numbers[0]
+    for n in list(numbers[1:]) + [None]:
+        if n is not None and n == prev + 1:
+            prev = n
+            continue
+        runs.append(str(start) if start == prev else f"{start}-{prev}")
+        if n is not None:
+            start = prev = n
+    noun = "Chunk" if len(numbers) == 1 else "Chunks"
+    return f"{noun} {', '.join(runs)}"
+
+
+def count_merge_calls(n: int) -> int:
+    """
+    Number of pairwise merges needed to reduce n analyses to at most two, merging
+    adjacent pairs level by level and carrying an odd one over unchanged.
+    """
+    calls = 0
+    while n > 2:
+        calls += n // 2
+        n = (n + 1) // 2
+    return calls
+
+
+def map_concurrently(
+    fn: Callable[[T], R],
+    items: Sequence[T],
+    max_workers: int,
+    on_done: Optional[Callable[[int], None]] = None,
+) -> List[R]:
+    """
+    Applies fn to every item on a thread pool and returns the results in input
+    order. Workers inherit the Streamlit script context so cached functions behave
+    as on the main thread; on_done(n_completed) is called from the calling thread.
+    If any call fails, requests still queued are cancelled before the error is
+    re-raised, so a bad key or quota error doesn't bill the rest of the batch.
+    """
+    results: List[R] = [None] * len(items)  # type: ignore[list-item]
+    if not items:
+        return results
+
+    ctx = get_script_run_ctx()
+    workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=workers, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+        futures = {ex.submit(fn, item): i for i, item in enumerate(items)}
+        try:
+            for done, fut in enumerate(as_completed(futures), start=1):
+                results[futures[fut]] = fut.result()
+                if on_done is not None:
+                    on_done(done)
+        except BaseException:
+            ex.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
 
 
 # ----------------------------
@@ -185,8 +690,11 @@ with st.sidebar:
     ui_key = st.text_input("OpenAI API Key (optional override)", type="password", value="")
     api_key = (ui_key.strip() or env_key.strip())
 
-    model = st.text_input("Model", value="gpt-5.2")
-    temperature = st.slider("Temperature", min_value=0.0, max_value=1.0, value=0.3, step=0.05)
+    # Pass 1 is template-driven extraction: a small model at temperature 0 is enough,
+    # and deterministic calls are served from the response cache on repeat runs.
+    pass1_model = st.text_input("Model (Pass 1: chunk analysis)", value="gpt-4o-mini")
+    pass2_model = st.text_input("Model (Pass 2: synthesis)", value="gpt-5.2")
+    temperature = st.slider("Temperature (Pass 2)", min_value=0.0, max_value=1.0, value=0.0, step=0.05)
 
     st.divider()
 
@@ -195,7 +703,10 @@ with st.sidebar:
 
     context = st.slider("Context lines (+/- around each match)", 0, 200, 40, 10)
     max_filtered_lines = st.number_input("Max filtered lines safeguard", min_value=100, max_value=200000, value=20000, step=1000)
-    chunk_size = st.number_input("Chunk size (characters)", min_value=2000, max_value=100000, value=20000, step=1000)
+    chunk_tokens = st.number_input("Chunk size (tokens)", min_value=500, max_value=100000, value=6000, step=500)
+    max_workers = st.slider("Parallel requests", min_value=1, max_value=16, value=8)
+    compress_analyses = st.checkbox("Compress chunk analyses to evidence bullets before synthesis", value=True)
+    dedupe_analyses = st.checkbox("Fold near-identical chunk analyses before synthesis", value=True)
 
     st.divider()
 
@@ -207,22 +718,30 @@ if not uploaded:
     st.info("Upload a journalctl file to begin.")
     st.stop()
 
-raw_bytes = uploaded.read()
-try:
-    text = raw_bytes.decode("utf-8", errors="replace")
-except Exception:
-    text = raw_bytes.decode(errors="replace")
+# The filter works on raw bytes and decodes only the kept lines, so the file is
+# never materialized as one big str or line list. getvalue() hands back the
+# upload's own bytes object (getbuffer() would force a private copy of it).
+raw_bytes = uploaded.getvalue()
 
-lines = text.splitlines()
+# The digest and line index depend only on the upload, so they are built once
+# per file and reused by every rerun of this session.
+if st.session_state.get("upload_id") != uploaded.file_id:
+    st.session_state.upload_id = uploaded.file_id
+    st.session_state.upload_digest = hashlib.sha256(raw_bytes).hexdigest()
+    st.session_state.upload_line_ends = index_line_ends(raw_bytes)
+raw_digest = st.session_state.upload_digest
+line_ends = st.session_state.upload_line_ends
 
 col1, col2 = st.columns([1, 1])
 with col1:
     st.subheader("Input stats")
-    st.write(f"- Total lines: **{len(lines):,}**")
+    st.write(f"- Total lines: **{len(line_ends):,}**")
     st.write(f"- TARGET_SERVICES: **{', '.join(target_services) if target_services else '(none)'}**")
 
-filtered_lines, hits = filter_lines_with_context(
-    lines=lines,
+filtered_text, filtered_count, hits, truncated, scan_stopped_early = filter_lines_with_context(
+    _buf=raw_bytes,
+    _line_ends=line_ends,
+    buf_digest=raw_digest,
     target_services=target_services,
     context=context,
     max_lines=int(max_filtered_lines),
@@ -231,10 +750,14 @@ filtered_lines, hits = filter_lines_with_context(
 with col2:
     st.subheader("Filtered stats")
     st.write(f"- Direct matches (hits): **{hits:,}**")
-    st.write(f"- Filtered lines (with context): **{len(filtered_lines):,}**")
+    st.write(f"- Filtered lines (with context): **{filtered_count:,}**")
+    if scan_stopped_early:
+        st.caption("Safeguard reached: the scan stopped early, so hits cover only the part of the file read so far.")
+    elif truncated:
+        st.caption(f"Safeguard reached: only the first {filtered_count:,} filtered lines are kept.")
 
 st.subheader("Filtered preview")
-preview = "\n".join(filtered_lines[:200])
+preview = "\n".join(filtered_text.split("\n", 200)[:200])
 st.code(preview if preview else "(no matching lines found)", language="text")
 
 if not api_key:
@@ -249,46 +772,125 @@ analyze = st.button("Analyze", type="primary")
 if not analyze:
     st.stop()
 
-# Build filtered text for analysis
-filtered_text = "\n".join(filtered_lines).strip()
-if not filtered_text:
+if not filtered_text or filtered_text.isspace():
     st.warning("No relevant lines were found for the selected TARGET_SERVICES.")
     st.stop()
 
-cfg = OpenAIConfig(api_key=api_key, model=model.strip(), temperature=float(temperature))
+cfg = OpenAIConfig(
+    api_key=api_key,
+    pass1_model=pass1_model.strip(),
+    pass2_model=pass2_model.strip(),
+    temperature=float(temperature),
+)
 client = OpenAI(api_key=cfg.api_key)
 
-chunks = chunk_text_by_chars(filtered_text, int(chunk_size))
+chunks = chunk_lines_by_tokens(filtered_text, int(chunk_tokens), cfg.pass1_model)
 
 st.subheader("Analysis progress")
 progress = st.progress(0)
 status = st.empty()
 
-chunk_outputs = []
-total_steps = len(chunks) + 1  # +1 for synthesis
+total_steps = len(chunks) + count_merge_calls(len(chunks)) + 1  # +1 for synthesis
 
-# Pass 1: chunk analyses
-for idx, chunk in enumerate(chunks, start=1):
-    status.write(f"Pass 1/2 — analyzing chunk {idx}/{len(chunks)} ...")
-    prompt = prompt_template.format(
+# Pass 1: chunk analyses (requests are I/O-bound, so they run concurrently)
+render_prompt = compile_prompt_template(prompt_template, target_services)
+prompts = [render_prompt(chunk) for chunk in chunks]
+
+
+def on_chunk_done(done: int) -> None:
+    status.write(f"Pass 1/2 — analyzed chunk {done}/{len(chunks)} ...")
+    progress.progress(min(0.99, done / total_steps))
+
+
+def analyze_chunk(prompt: str) -> Tuple[str, str]:
+    """
+    Returns the full chunk analysis (shown to the user) and the text handed to
+    Pass 2: a short evidence digest when compression is on, else the analysis.
+    """
+    out = call_openai_responses(client, cfg.pass1_model, 0.0, prompt).strip()
+    if not compress_analyses or not out:
+        return out, out
+    compress_prompt = COMPRESS_PROMPT.format(target_services=target_services, analysis=out)
+    digest = call_openai_responses(
+        client, cfg.pass1_model, 0.0, compress_prompt, max_output_tokens=COMPRESS_MAX_OUTPUT_TOKENS
+    ).strip()
+    return out, digest or out
+
+
+status.write(f"Pass 1/2 — analyzing {len(chunks)} chunks ...")
+analyzed = map_concurrently(analyze_chunk, prompts, max_workers=int(max_workers), on_done=on_chunk_done)
+chunk_outputs = [out for out, _ in analyzed]
+synthesis_inputs = [digest for _, digest in analyzed]
+
+# Pass 2: tree synthesis. Adjacent analyses are merged pairwise, level by level,
+# until at most two remain, so no prompt grows with the number of chunks.
+# Each partial carries the chunk numbers it covers; after near-duplicate folding
+# these are no longer contiguous.
+partials = [((i,), out) for i, out in enumerate(synthesis_inputs, start=1)]
+
+# Long incidents repeat the same failure block many times; near-identical
+# analyses are folded into the first one so Pass 2 only reads them once.
+if dedupe_analyses and len(synthesis_inputs) > 2:
+    status.write("Pass 2/2 — grouping near-identical chunk analyses ...")
+    try:
+        embeddings = embed_texts(client, EMBEDDING_MODEL, [out or "(empty)" for out in synthesis_inputs])
+    except Exception as e:
+        # Folding is only an optimization; Pass 2 still works on the unfolded analyses.
+        st.warning(f"Could not group similar chunk analyses, merging all of them instead: {e}")
+    else:
+        partials = []
+        for group in group_near_duplicates(embeddings, DUPLICATE_SIMILARITY):
+            first, repeats = group[0] + 1, [i + 1 for i in group[1:]]
+            out = synthesis_inputs[first - 1]
+            if repeats:
+                out += (
+                    f"\n\n({len(repeats)} similar chunk analyses omitted; "
+                    f"the same findings were reported for chunks {', '.join(map(str, repeats))}.)"
+                )
+            partials.append(((first,), out))
+        total_steps = len(chunks) + count_merge_calls(len(partials)) + 1
+
+steps_done = len(chunks)
+
+
+def merge_pair(pair: Sequence[Tuple[Tuple[int, ...], str]]) -> Tuple[Tuple[int, ...], str]:
+    (first_chunks, first), (second_chunks, second) = pair
+    merge_prompt = MERGE_PROMPT.format(
         target_services=target_services,
-        log_text=chunk,
+        first_label=label_chunks(first_chunks).upper(),
+        first=first,
+        second_label=label_chunks(second_chunks).upper(),
+        second=second,
     )
-    out = call_openai_responses(client, cfg.model, cfg.temperature, prompt)
-    chunk_outputs.append(out.strip())
-    progress.progress(min(0.99, idx / total_steps))
+    merged = call_openai_responses(client, cfg.pass2_model, cfg.temperature, merge_prompt).strip()
+    return tuple(sorted(first_chunks + second_chunks)), merged
+
+
+def on_merge_done(done: int) -> None:
+    progress.progress(min(0.99, (steps_done + done) / total_steps))
+
+
+while len(partials) > 2:
+    pairs = [partials[i : i + 2] for i in range(0, len(partials) - 1, 2)]
+    status.write(f"Pass 2/2 — merging {len(partials)} analyses pairwise ...")
+    merged = map_concurrently(merge_pair, pairs, max_workers=int(max_workers), on_done=on_merge_done)
+    steps_done += len(pairs)
+    partials = merged + partials[2 * len(pairs) :]
 
-# Pass 2: synthesis
 status.write("Pass 2/2 — synthesizing final report ...")
 joined = "\n\n---\n\n".join(
-    f"Chunk {i+1} analysis:\n{chunk_outputs[i]}" for i in range(len(chunk_outputs))
+    f"{label_chunks(covered)} analysis:\n{out}" for covered, out in partials
 )
 
 synth_prompt = SYNTHESIS_PROMPT.format(
     target_services=target_services,
     chunk_analyses=joined,
 )
-final_report = call_openai_responses(client, cfg.model, cfg.temperature, synth_prompt).strip()
+live_report = st.empty()
+final_report = stream_openai_responses(
+    client, cfg.pass2_model, cfg.temperature, synth_prompt, on_text=live_report.markdown
+).strip()
+live_report.empty()
 progress.progress(1.0)
 status.write("Done ✅")
 